@@ -1,13 +1,20 @@
 import asyncio
 import logging
 import os
+import sqlite3
+import ssl
 import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields
 from pathlib import Path
+from functools import lru_cache, wraps
+from itertools import groupby
 from math import ceil
 
-import aiosqlite
+import aiohttp
+import certifi
 from aiogram import Bot, Dispatcher, types
-from aiogram.utils import executor
+from aiogram.utils import executor, json
 from dotenv import load_dotenv
 
 # --------------------------------------
@@ -22,7 +29,24 @@ if not BOT_TOKEN:
 # Base settings
 # --------------------------------------
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=BOT_TOKEN)
+
+
+class PooledBot(Bot):
+    """Bot whose HTTP session pools connections and keeps TLS to Telegram alive."""
+
+    async def get_new_session(self) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                keepalive_timeout=75,
+                ttl_dns_cache=300,
+                ssl=ssl.create_default_context(cafile=certifi.where()),
+            ),
+            json_serialize=json.dumps,
+        )
+
+
+bot = PooledBot(token=BOT_TOKEN, timeout=30)
 dp = Dispatcher(bot)
 
 ASSETS_DIR = Path("assets")
@@ -33,63 +57,237 @@ WATER_COOLDOWN = 300  # 5 minutes
 DAILY_COOLDOWN = 24 * 3600
 SUN_COOLDOWN = 600  # 10 minutes
 MAX_LEVEL = 20
+SHUTDOWN_TIMEOUT = 10  # seconds to let running handlers finish
 
 # --------------------------------------
 # Database
 # --------------------------------------
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                created REAL,
-                last_water REAL,
-                last_daily REAL,
-                level INTEGER,
-                exp INTEGER,
-                sun INTEGER,
-                water INTEGER
-            )
-            """
+# One in-process connection; only the writer task touches it after startup
+DB: sqlite3.Connection = None
+
+# All writes go through one writer task that commits them in groups
+WRITE_BATCH = 64
+WRITE_FLUSH_INTERVAL = 0.02  # 20 ms
+WRITE_Q: asyncio.Queue = None
+WRITER: asyncio.Task = None
+
+
+def _open_db() -> sqlite3.Connection:
+    # autocommit mode: the writer issues BEGIN/COMMIT itself
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    # WAL + NORMAL: one append and a single fsync per commit
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-64000")  # ~64 MB
+    db.execute("PRAGMA mmap_size=134217728")  # 128 MB
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            created REAL,
+            last_water REAL,
+            last_daily REAL,
+            level INTEGER,
+            exp INTEGER,
+            sun INTEGER,
+            water INTEGER,
+            last_sun REAL DEFAULT 0
         )
-        await db.commit()
-
-async def ensure_user(uid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT user_id FROM users WHERE user_id=?", (uid,))
-        row = await cur.fetchone()
-        if not row:
-            await db.execute(
-                "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (uid, time.time(), 0.0, 0.0, 1, 0, 0, 0),
-            )
-            await db.commit()
-
-async def get_user(uid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT user_id, created, last_water, last_daily, level, exp, sun, water FROM users WHERE user_id=?",
-            (uid,),
+        """
+    )
+    # databases created before last_sun existed
+    columns = {row[1] for row in db.execute("PRAGMA table_info(users)")}
+    if "last_sun" not in columns:
+        db.execute("ALTER TABLE users ADD COLUMN last_sun REAL DEFAULT 0")
+    return db
+
+async def init_db():
+    global DB, WRITE_Q, WRITER
+    DB = await asyncio.to_thread(_open_db)
+    WRITE_Q = asyncio.Queue()
+    WRITER = asyncio.create_task(writer_task(WRITE_Q))
+
+async def close_db():
+    global DB, WRITE_Q, WRITER
+    if WRITER is not None:
+        # new writes now raise; None tells the writer to drain the queue and stop
+        queue, WRITE_Q = WRITE_Q, None
+        queue.put_nowait(None)
+        await WRITER
+        WRITER = None
+    if DB is not None:
+        DB.close()
+        DB = None
+
+def _write_queue() -> asyncio.Queue:
+    if WRITE_Q is None:
+        raise RuntimeError("Database is closed")
+    return WRITE_Q
+
+async def writer_task(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    stop = False
+    while True:
+        batch = []
+        if not stop:
+            item = await queue.get()
+            if item is None:
+                stop = True
+            else:
+                batch.append(item)
+        deadline = loop.time() + WRITE_FLUSH_INTERVAL
+        while len(batch) < WRITE_BATCH:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if stop or timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                # keep draining whatever was queued around the sentinel
+                stop = True
+                continue
+            batch.append(item)
+        if batch:
+            await flush_writes(batch)
+        elif stop:
+            return
+
+def _run_batch(stmts):
+    """Run (sql, params, wants_row) statements in one transaction.
+
+    Consecutive fire-and-forget statements sharing the same SQL are sent
+    with a single executemany(); order is preserved. If that fails, the
+    group is rolled back and re-run row by row so only the bad rows fail.
+    Returns (row, error) per statement.
+    """
+    results = []
+    DB.execute("BEGIN")
+    try:
+        for (sql, wants_row), group in groupby(stmts, key=lambda st: (st[0], st[2])):
+            params = [st[1] for st in group]
+            if not wants_row and len(params) > 1:
+                DB.execute("SAVEPOINT grp")
+                try:
+                    DB.executemany(sql, params)
+                except sqlite3.Error:
+                    DB.execute("ROLLBACK TO grp")
+                else:
+                    results.extend([(None, None)] * len(params))
+                    continue
+                finally:
+                    DB.execute("RELEASE grp")
+            for p in params:
+                try:
+                    rows = DB.execute(sql, p).fetchall()
+                    results.append((rows[0] if rows else None, None))
+                except sqlite3.Error as e:
+                    results.append((None, e))
+        DB.execute("COMMIT")
+    except BaseException:
+        if DB.in_transaction:
+            DB.execute("ROLLBACK")
+        raise
+    return results
+
+async def flush_writes(batch):
+    """Run a batch of writes off the event loop and resolve their futures."""
+    try:
+        results = await asyncio.to_thread(
+            _run_batch, [(sql, params, fut is not None) for sql, params, fut in batch]
         )
-        return await cur.fetchone()
+    except Exception as e:
+        logging.exception("Write batch failed")
+        results = [(None, e)] * len(batch)
+    for (_, _, fut), (row, err) in zip(batch, results):
+        if fut is None:
+            # fire-and-forget write from update_user()
+            if err is not None:
+                logging.error("Queued write failed: %s", err)
+            continue
+        if fut.done():
+            continue
+        if err is not None:
+            fut.set_exception(err)
+        else:
+            fut.set_result(row)
+
+async def write(sql: str, params):
+    """Queue a write for the writer task and wait for its RETURNING row."""
+    fut = asyncio.get_running_loop().create_future()
+    await _write_queue().put((sql, params, fut))
+    return await fut
+
+@dataclass(slots=True)
+class User:
+    """One users row; field order matches the table columns."""
+    user_id: int
+    created: float
+    last_water: float
+    last_daily: float
+    level: int
+    exp: int
+    sun: int
+    water: int
+    last_sun: float
+
+USER_COLUMNS = ", ".join(f.name for f in fields(User))
+
+# Write-through LRU cache of users; SQLite only sees writes for cached users
+USER_CACHE_SIZE = 10_000
+USERS: "OrderedDict[int, User]" = OrderedDict()
+
+async def load_user(uid: int):
+    """Create the user on first contact and return the row in one statement."""
+    return await write(
+        "INSERT INTO users VALUES (?, ?, 0.0, 0.0, 1, 0, 0, 0, 0.0) "
+        "ON CONFLICT(user_id) DO UPDATE SET user_id=user_id "
+        f"RETURNING {USER_COLUMNS}",
+        (uid, time.time()),
+    )
 
-async def update_user(uid: int, **kwargs):
+async def get_or_create(uid: int) -> User:
+    """Return the cached user, loading (or creating) it on a miss."""
+    u = USERS.get(uid)
+    if u is None:
+        row = await load_user(uid)
+        # another handler may have loaded it while we were waiting
+        u = USERS.setdefault(uid, User(*row))
+        if len(USERS) > USER_CACHE_SIZE:
+            USERS.popitem(last=False)
+    USERS.move_to_end(uid)
+    return u
+
+@lru_cache(maxsize=32)
+def _update_sql(cols: tuple) -> str:
+    return "UPDATE users SET " + ", ".join(c + "=?" for c in cols) + " WHERE user_id=?"
+
+def update_user(uid: int, **kwargs):
+    """Update the cached user in place and queue the write without waiting."""
     if not kwargs:
         return
-    parts = ", ".join([f"{k}=?" for k in kwargs.keys()])
-    values = list(kwargs.values())
-    values.append(uid)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(f"UPDATE users SET {parts} WHERE user_id=?", values)
-        await db.commit()
+    queue = _write_queue()
+    keys = tuple(kwargs)
+    u = USERS.get(uid)
+    if u is not None:
+        for k in keys:
+            setattr(u, k, kwargs[k])
+    params = (*map(kwargs.__getitem__, keys), uid)
+    queue.put_nowait((_update_sql(keys), params, None))
 
 # --------------------------------------
 # Leveling
 # --------------------------------------
 
+EXP_TABLE = tuple(ceil(5 * (level ** 1.6)) for level in range(MAX_LEVEL + 1))
+
 def exp_needed_for(level: int) -> int:
-    return ceil(5 * (level ** 1.6))
+    return EXP_TABLE[level]
 
 # --------------------------------------
 # ASCII Art
@@ -102,7 +300,7 @@ ASCII_TREE = {
     5: "🌴",
 }
 
-def ascii_for(level: int) -> str:
+def _build_ascii(level: int) -> str:
     if level < 3:
         return "  " + ASCII_TREE.get(level, "🌱") + "  "
 
@@ -114,6 +312,11 @@ def ascii_for(level: int) -> str:
     )
     return art
 
+ASCII_CACHE = tuple(_build_ascii(level) for level in range(MAX_LEVEL + 1))
+
+def ascii_for(level: int) -> str:
+    return ASCII_CACHE[level]
+
 # --------------------------------------
 # Keyboards
 # --------------------------------------
@@ -128,33 +331,49 @@ def main_keyboard():
     kb.add("👤 Профиль")
     return kb
 
+# identical for every user, so build it once
+MAIN_KB = main_keyboard()
+
 # --------------------------------------
 # Handlers
 # --------------------------------------
 
+# aiogram runs each update in its own task and never waits for them, so the
+# shutdown hook uses this set to let running handlers queue their writes
+HANDLER_TASKS = set()
+
+def tracked(handler):
+    @wraps(handler)
+    async def wrapper(m: types.Message):
+        task = asyncio.current_task()
+        HANDLER_TASKS.add(task)
+        try:
+            return await handler(m)
+        finally:
+            HANDLER_TASKS.discard(task)
+    return wrapper
+
+
 @dp.message_handler(commands=["start"])
+@tracked
 async def cmd_start(m: types.Message):
-    await init_db()
-    await ensure_user(m.from_user.id)
-    await m.answer("Добро пожаловать в Wild Tree!", reply_markup=main_keyboard())
+    await get_or_create(m.from_user.id)
+    await m.answer("Добро пожаловать в Wild Tree!", reply_markup=MAIN_KB)
 
 
 # 🌱 СТАТУС (БЕЗ EXP)
-@dp.message_handler(lambda m: m.text == "🌱 Посадить / Статус")
 async def handler_status(m: types.Message):
-    await ensure_user(m.from_user.id)
-    u = await get_user(m.from_user.id)
-    uid, created, last_water, last_daily, level, exp, sun, water = u
+    u = await get_or_create(m.from_user.id)
 
-    needed = exp_needed_for(level)
-    art = ascii_for(level)
+    needed = exp_needed_for(u.level)
+    art = ascii_for(u.level)
 
     text = (
         f"🌱 Статус дерева\n\n"
-        f"Уровень: {level}/{MAX_LEVEL}\n"
-        f"EXP: {exp}/{needed}\n"
-        f"Sun: {sun} ☀️\n"
-        f"Water: {water} 💧\n\n"
+        f"Уровень: {u.level}/{MAX_LEVEL}\n"
+        f"EXP: {u.exp}/{needed}\n"
+        f"Sun: {u.sun} ☀️\n"
+        f"Water: {u.water} 💧\n\n"
         f"{art}"
     )
 
@@ -162,74 +381,62 @@ async def handler_status(m: types.Message):
 
 
 # 💧 Полить
-@dp.message_handler(lambda m: m.text == "💧 Полить")
 async def handler_water(m: types.Message):
-    await ensure_user(m.from_user.id)
-    u = await get_user(m.from_user.id)
-    uid, created, last_water, last_daily, level, exp, sun, water = u
+    u = await get_or_create(m.from_user.id)
     now = time.time()
+    elapsed = now - (u.last_water or 0)
 
     # Проверка кулдауна
-    if now - (last_water or 0) < WATER_COOLDOWN:
-        remain = int(WATER_COOLDOWN - (now - last_water))
-        mins = remain // 60
-        secs = remain % 60
+    if elapsed < WATER_COOLDOWN:
+        remain = int(WATER_COOLDOWN - elapsed)
+        mins, secs = divmod(remain, 60)
         return await m.answer(
             f"💧 Поливать можно раз в 5 минут!\n"
             f"Подожди {mins} мин {secs} сек."
         )
 
     # Успешный полив
-    water += 1
-    exp += 2
-    await update_user(uid, water=water, exp=exp, last_water=now)
+    update_user(u.user_id, water=u.water + 1, exp=u.exp + 2, last_water=now)
 
     await m.answer(f"💧 Полив! Water +1, EXP +2")
-    await check_level_up(m, uid)
+    await check_level_up(m, u)
 
 
 # 🌞 Солнце
-@dp.message_handler(lambda m: m.text == "🌞 Дать солнце")
 async def handler_sun(m: types.Message):
-    await ensure_user(m.from_user.id)
-    u = await get_user(m.from_user.id)
-    uid, created, last_water, last_daily, level, exp, sun, water = u
+    u = await get_or_create(m.from_user.id)
     now = time.time()
+    elapsed = now - (u.last_sun or 0)
 
-    last_sun = getattr(handler_sun, "last_sun", 0)
-    if now - last_sun < SUN_COOLDOWN:
-        remain = int(SUN_COOLDOWN - (now - last_sun))
-        mins = remain // 60
-        secs = remain % 60
+    if elapsed < SUN_COOLDOWN:
+        remain = int(SUN_COOLDOWN - elapsed)
+        mins, secs = divmod(remain, 60)
         return await m.answer(f"☀️ Солнце можно давать раз в 10 минут!\nПодожди {mins} мин {secs} сек.")
 
-    handler_sun.last_sun = now
-
-    sun += 1
-    exp += 2
-    await update_user(uid, sun=sun, exp=exp)
+    update_user(u.user_id, sun=u.sun + 1, exp=u.exp + 2, last_sun=now)
 
     await m.answer(f"☀️ Солнце! Sun +1, EXP +2")
-    await check_level_up(m, uid)
+    await check_level_up(m, u)
 
 
 # 🎉 Levelup
-async def check_level_up(m: types.Message, uid: int):
-    u = await get_user(uid)
-    uid, created, last_water, last_daily, level, exp, sun, water = u
+async def check_level_up(m: types.Message, u: User):
+    level, exp, sun, water = u.level, u.exp, u.sun, u.water
+    msgs = []
 
-    while level < MAX_LEVEL and exp >= exp_needed_for(level):
-        exp -= exp_needed_for(level)
+    while level < MAX_LEVEL and exp >= (needed := EXP_TABLE[level]):
+        exp -= needed
         level += 1
         sun += 1
         water += 1
-        await m.answer(f"🎉 Новый уровень: {level}! Sun+1, Water+1")
+        msgs.append(f"🎉 Новый уровень: {level}! Sun+1, Water+1")
 
-    await update_user(uid, level=level, exp=exp, sun=sun, water=water)
+    if msgs:
+        update_user(u.user_id, level=level, exp=exp, sun=sun, water=water)
+        await m.answer("\n".join(msgs))
 
 
 # 📜 Roadmap
-@dp.message_handler(lambda m: m.text == "📜 Roadmap")
 async def handler_roadmap(m: types.Message):
     await m.answer(
         "🗺️ Roadmap:\n"
@@ -242,67 +449,99 @@ async def handler_roadmap(m: types.Message):
 
 
 # 💰 Staking
-@dp.message_handler(lambda m: m.text == "💰 Staking (скоро)")
 async def handler_staking(m: types.Message):
     await m.answer("💰 Staking будет добавлен позже!")
 
 
 # 🎁 Daily bonus
-@dp.message_handler(lambda m: m.text == "🎁 Ежедневный бонус")
 async def handler_daily(m: types.Message):
-    await ensure_user(m.from_user.id)
-    u = await get_user(m.from_user.id)
-    uid, created, last_water, last_daily, level, exp, sun, water = u
+    u = await get_or_create(m.from_user.id)
     now = time.time()
+    elapsed = now - (u.last_daily or 0)
 
-    if now - (last_daily or 0) < DAILY_COOLDOWN:
-        remain = int((last_daily + DAILY_COOLDOWN) - now)
-        hrs = remain // 3600
-        mins = (remain % 3600) // 60
+    if elapsed < DAILY_COOLDOWN:
+        remain = int(DAILY_COOLDOWN - elapsed)
+        hrs, rem = divmod(remain, 3600)
+        mins = rem // 60
         return await m.answer(f"Следующий бонус через {hrs}ч {mins}м")
 
-    reward_sun = 1 + level // 5
-    reward_water = 1 + level // 6
-    reward_exp = 5 + level
-
-    sun += reward_sun
-    water += reward_water
-    exp += reward_exp
+    reward_sun = 1 + u.level // 5
+    reward_water = 1 + u.level // 6
+    reward_exp = 5 + u.level
 
-    await update_user(uid, sun=sun, water=water, exp=exp, last_daily=now)
+    update_user(
+        u.user_id,
+        sun=u.sun + reward_sun,
+        water=u.water + reward_water,
+        exp=u.exp + reward_exp,
+        last_daily=now,
+    )
 
     await m.answer(
         f"🎁 Ежедневный бонус!\nSun+{reward_sun}, Water+{reward_water}, EXP+{reward_exp}"
     )
-    await check_level_up(m, uid)
+    await check_level_up(m, u)
 
 
 # 👤 Profile
-@dp.message_handler(lambda m: m.text == "👤 Профиль")
 async def handler_profile(m: types.Message):
-    await ensure_user(m.from_user.id)
-    u = await get_user(m.from_user.id)
-    uid, created, last_water, last_daily, level, exp, sun, water = u
-    needed = exp_needed_for(level)
+    u = await get_or_create(m.from_user.id)
+    needed = exp_needed_for(u.level)
 
     await m.answer(
         f"👤 Профиль: {m.from_user.first_name}\n"
-        f"Уровень: {level}/{MAX_LEVEL}\n"
-        f"EXP: {exp}/{needed}\n"
-        f"Sun: {sun}☀️\n"
-        f"Water: {water}💧"
+        f"Уровень: {u.level}/{MAX_LEVEL}\n"
+        f"EXP: {u.exp}/{needed}\n"
+        f"Sun: {u.sun}☀️\n"
+        f"Water: {u.water}💧"
     )
 
 
 # fallback
-@dp.message_handler()
 async def fallback(m: types.Message):
     await m.answer("Используй кнопки меню!")
 
+
+# Menu buttons are routed with one dict lookup instead of a filter per handler
+ROUTES = {
+    "🌱 Посадить / Статус": handler_status,
+    "💧 Полить": handler_water,
+    "🌞 Дать солнце": handler_sun,
+    "📜 Roadmap": handler_roadmap,
+    "💰 Staking (скоро)": handler_staking,
+    "🎁 Ежедневный бонус": handler_daily,
+    "👤 Профиль": handler_profile,
+}
+
+@dp.message_handler()
+@tracked
+async def router(m: types.Message):
+    await ROUTES.get(m.text, fallback)(m)
+
 # --------------------------------------
 # Start
 # --------------------------------------
+async def on_shutdown(dp: Dispatcher):
+    # aiogram runs this before it stops polling. Stop it without waiting for
+    # the pending long poll, then give running handlers a bounded chance to
+    # queue their writes; anything still running after that is logged and
+    # its later writes fail with "Database is closed".
+    dp.stop_polling()
+    pending = HANDLER_TASKS - {asyncio.current_task()}
+    if pending:
+        _, pending = await asyncio.wait(pending, timeout=SHUTDOWN_TIMEOUT)
+        if pending:
+            logging.warning("%d handler(s) still running at shutdown", len(pending))
+    await close_db()
+
 if __name__ == "__main__":
+    try:
+        import uvloop
+    except ImportError:  # uvloop is not available on Windows
+        pass
+    else:
+        uvloop.install()
+
     loop = asyncio.get_event_loop()
     loop.run_until_complete(init_db())
-    executor.start_polling(dp, skip_updates=True)
+    executor.start_polling(dp, skip_updates=True, on_shutdown=on_shutdown)